@@ -1,10 +1,12 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
+import inspect
 import math
 import torch.nn.functional as F
 from torch import nn
 import torch
 import sys, os
 
+from ..ops.upsample_add.modules.upsample_add import upsample2x_add
 from .backbone_base import Backbone
 from .resnet import (
     build_resnet34_backbone,
@@ -21,6 +23,13 @@ __all__ = [
     "FPN",
     "build_resnet34_fpn_backbone",
     "build_resnet18_fpn_backbone",
+    "compile_fpn_backbone",
+    "freeze_fpn_backbone",
+    "convert_fpn_to_channels_last",
+    "export_fpn_backbone",
+    "export_fpn_backbone_trt",
+    "enable_fpn_lateral_stream",
+    "enable_fpn_autocast",
 ]
 
 
@@ -71,11 +80,7 @@ class FPN(Backbone):
         in_channels = [bottom_up.out_feature_channels[f] for f in in_features]
 
         _assert_strides_are_log2_contiguous(in_strides)
-        lateral_convs = []
-        output_convs = []
-        lateral_names = []
-        output_conv_names = []
-
+        stages = [int(math.log2(s)) for s in in_strides]
         use_bias = norm == ""
 
         for idx, in_channels in enumerate(in_channels):
@@ -102,39 +107,60 @@ class FPN(Backbone):
             )
             # weight_init.c2_xavier_fill(lateral_conv)
             # weight_init.c2_xavier_fill(output_conv)
-            stage = int(math.log2(in_strides[idx]))
-            self.add_module("fpn_lateral{}".format(stage), lateral_conv)
-            self.add_module("fpn_output{}".format(stage), output_conv)
-
-            lateral_convs.append(lateral_conv)
-            lateral_names.append("fpn_lateral{}".format(stage))
-            output_convs.append(output_conv)
-            output_conv_names.append("fpn_output{}".format(stage))
+            self.add_module(f"fpn_lateral{stages[idx]}", lateral_conv)
+            self.add_module(f"fpn_output{stages[idx]}", output_conv)
 
-        # Place convs into top-down order (from low to high resolution)
+        # Place conv names into top-down order (from low to high resolution)
         # to make the top-down computation in forward clearer.
-        self.lateral_convs = lateral_convs[::-1]
-        self.output_convs = output_convs[::-1]
-        self.lateral_names = lateral_names[::-1]
-        self.output_conv_names = output_conv_names[::-1]
+        self._lateral_names = tuple(f"fpn_lateral{s}" for s in reversed(stages))
+        self._output_names = tuple(f"fpn_output{s}" for s in reversed(stages))
 
         self.top_block = top_block
         self.in_features = in_features
+        # top-down (low to high resolution) order used by forward
+        self._in_features_reversed = tuple(reversed(in_features))
         self.bottom_up = bottom_up
         # Return feature names are "p<stage>", like ["p2", "p3", ..., "p6"]
         self._out_feature_strides = {
-            "p{}".format(int(math.log2(s))): s for s in in_strides
+            "p{}".format(stage): s for stage, s in zip(stages, in_strides)
         }
         # top block output feature maps.
         if self.top_block is not None:
+            stage = stages[-1]
             for s in range(stage, stage + self.top_block.num_levels):
                 self._out_feature_strides["p{}".format(s + 1)] = 2 ** (s + 1)
 
         self._out_features = list(self._out_feature_strides.keys())
+        # Decide once where the top block reads its input: a bottom up output
+        # (e.g. "res5" for P6P7) or one of the FPN outputs (e.g. "p5"). Bottom
+        # up outputs take precedence, as names like "p5" can be both.
+        self._top_block_from_bottom_up = False
+        self._top_block_in_idx = -1
+        if self.top_block is not None:
+            if self.top_block.in_feature in bottom_up.out_feature_strides:
+                self._top_block_from_bottom_up = True
+            else:
+                self._top_block_in_idx = self._out_features.index(
+                    self.top_block.in_feature
+                )
         self._out_feature_channels = {k: out_channels for k in self._out_features}
+        # key order of forward(); forward_features() returns values in this order
+        self._output_keys = tuple(self._out_features) + ("res2",)
         self._size_divisibility = in_strides[-1]
         assert fuse_type in {"avg", "sum"}
         self._fuse_type = fuse_type
+        # "avg" fusion is a constant scale on the sum, so keep it as a plain
+        # float that can be folded into the add instead of a per-level branch.
+        self._fuse_scale = 0.5 if fuse_type == "avg" else 1.0
+        # replaced by a compiled version in compile_fpn_backbone(top_down_only=True)
+        self._top_down_step = _top_down_step
+        # set by convert_fpn_to_channels_last
+        self._channels_last = False
+        # device -> side stream for the lateral convs, enabled by
+        # enable_fpn_lateral_stream; streams are created on first use
+        self._lateral_streams = None
+        # set by enable_fpn_autocast
+        self._autocast_dtype = None
 
     # def to_dev(self, dev_id):
     #    self.bottom_up.to_dev(dev_id)
@@ -146,56 +172,132 @@ class FPN(Backbone):
     def size_divisibility(self):
         return self._size_divisibility
 
+    @property
+    def lateral_convs(self):
+        """
+        list[Conv2d]: lateral 1x1 convs in top-down order. Looked up in
+        `_modules` so that module replicas resolve to their own convs. Not used
+        by forward, which indexes `_modules` per level directly.
+        """
+        return [self._modules[name] for name in self._lateral_names]
+
+    @property
+    def output_convs(self):
+        """
+        list[Conv2d]: output 3x3 convs in top-down order.
+        """
+        return [self._modules[name] for name in self._output_names]
+
     def forward(self, x):
         """
         Args:
-            input (dict[str: Tensor]): mapping feature map name (e.g., "res5") to
-                feature map tensor for each feature level in high to low resolution order.
+            x (Tensor): input images of shape (N, C, H, W).
 
         Returns:
             dict[str: Tensor]:
                 mapping from feature map name to FPN feature map tensor
                 in high to low resolution order. Returned feature names follow the FPN
                 paper convention: "p<stage>", where stage has stride = 2 ** stage e.g.,
-                ["p2", "p3", ..., "p6"].
+                ["p2", "p3", ..., "p6"]. The bottom up "res2" map is passed through.
+        """
+        return dict(zip(self._output_keys, self.forward_features(x)))
+
+    def forward_features(self, x):
+        """
+        Same as :meth:`forward`, but returns the feature maps as a tuple ordered
+        like `self._output_keys`. Tracing, export and compilation work best on
+        this fixed-arity form.
+
+        Args:
+            x (Tensor): input images of shape (N, C, H, W).
+
+        Returns:
+            tuple[Tensor]: FPN feature maps in high to low resolution order,
+                followed by the bottom up "res2" map.
         """
+        if self._channels_last:
+            # every conv and pooling op downstream keeps the NHWC layout
+            x = x.contiguous(memory_format=torch.channels_last)
+        if self._autocast_dtype is not None:
+            with torch.autocast(x.device.type, dtype=self._autocast_dtype):
+                return self._forward_features(x)
+        return self._forward_features(x)
+
+    def _forward_features(self, x):
         # Reverse feature maps into top-down order (from low to high resolution)
         bottom_up_features = self.bottom_up(x)
 
-        x = [bottom_up_features[f] for f in self.in_features[::-1]]
-        results = []
-        prev_features = self.lateral_convs[0](x[0])
-        results.append(self.output_convs[0](prev_features))
+        x = [bottom_up_features[f] for f in self._in_features_reversed]
+        results = self._top_down(x)
+        # results were produced top-down; flip them to high-to-low resolution.
+        results.reverse()
 
-        for features, lateral_conv_name, output_conv_name in zip(
-            x[1:], self.lateral_names[1:], self.output_conv_names[1:]
-        ):
-            lateral_conv = self._modules[lateral_conv_name]
-            output_conv = self._modules[output_conv_name]
+        if self.top_block is not None:
+            if self._top_block_from_bottom_up:
+                top_block_in_feature = bottom_up_features[self.top_block.in_feature]
+            else:
+                top_block_in_feature = results[self._top_block_in_idx]
+            results.extend(self.top_block(top_block_in_feature))
+        results.append(bottom_up_features["res2"])
+        # forward() zips these with the keys, so a wrong count would mislabel maps
+        assert len(results) == len(self._output_keys)
+        return tuple(results)
+
+    def _top_down(self, x):
+        # convs are indexed by level straight from _modules, which keeps
+        # module replicas on their own convs without building lists per call
+        modules = self._modules
+        lateral_names = self._lateral_names
+        output_names = self._output_names
+        side_laterals = None
+        if self._lateral_streams is not None and x[0].is_cuda:
+            side_laterals = self._side_stream_laterals(x)
 
-            top_down_features = F.interpolate(
-                prev_features, scale_factor=2, mode="nearest"
+        results = []
+        prev_features = modules[lateral_names[0]](x[0])
+        results.append(modules[output_names[0]](prev_features))
+
+        for i in range(1, len(lateral_names)):
+            if side_laterals is None:
+                lateral_features = modules[lateral_names[i]](x[i])
+            else:
+                lateral_features, event = side_laterals[i - 1]
+                current_stream = torch.cuda.current_stream(x[i].device)
+                current_stream.wait_event(event)
+                # allocated on the side stream but consumed (and freed) on this one
+                lateral_features.record_stream(current_stream)
+            prev_features, out = self._top_down_step(
+                modules[output_names[i]],
+                lateral_features,
+                prev_features,
+                self._fuse_scale,
             )
-            lateral_features = lateral_conv(features)
+            results.append(out)
+        return results
 
-            prev_features = lateral_features + top_down_features
-            if self._fuse_type == "avg":
-                prev_features /= 2
-            results.insert(0, output_conv(prev_features))
+    def _side_stream_laterals(self, x):
+        """
+        Issue the lateral convs below the coarsest level on a side stream of the
+        inputs' device, so they overlap with the top-down chain on the current
+        stream.
 
-        if self.top_block is not None:
-            top_block_in_feature = bottom_up_features.get(
-                self.top_block.in_feature, None
-            )
-            if top_block_in_feature is None:
-                top_block_in_feature = results[
-                    self._out_features.index(self.top_block.in_feature)
-                ]
-            results.extend(self.top_block(top_block_in_feature))
-        assert len(self._out_features) == len(results)
-        outputs = dict(zip(self._out_features, results))
-        outputs["res2"] = bottom_up_features["res2"]
-        return outputs
+        Returns:
+            list[(Tensor, torch.cuda.Event)]: the lateral features of levels
+                1.. in top-down order, each with the event marking its completion.
+        """
+        device = x[0].device
+        stream = self._lateral_streams.get(device)
+        if stream is None:
+            stream = torch.cuda.Stream(device=device)
+            self._lateral_streams[device] = stream
+        # the bottom up features were produced on the current stream
+        stream.wait_stream(torch.cuda.current_stream(device))
+        laterals = []
+        with torch.cuda.stream(stream):
+            for name, features in zip(self._lateral_names[1:], x[1:]):
+                lateral_features = self._modules[name](features)
+                laterals.append((lateral_features, stream.record_event()))
+        return laterals
 
     def output_shape(self):
         return {
@@ -209,13 +311,12 @@ class FPN(Backbone):
     def load_pretrain(self, model_path):
         if not os.path.exists(model_path):
             print("=> no checkpoint found at '{}'".format(model_path))
-        checkpoint = pkl.load(open(model_path, "rb"))["model"]
-
-        new_checkpoint = {}
-        for k, v in checkpoint.items():
-            if k.split(".")[0] == "backbone":
-                new_checkpoint[k[9:]] = torch.from_numpy(v)
-        checkpoint = new_checkpoint
+        checkpoint = _load_checkpoint(model_path)
+        checkpoint = {
+            k[len("backbone.") :]: v
+            for k, v in checkpoint.items()
+            if k.startswith("backbone.")
+        }
         self.load_state_dict(checkpoint, strict=True)
         ckpt_keys = set(checkpoint.keys())
         own_keys = set(self.state_dict().keys())
@@ -232,11 +333,7 @@ class FPN(Backbone):
             print("successfully load model from {}".format(model_path))
 
     def load_bottom_up_pretrain(self, model_path, cfg=None):
-        checkpoint = pkl.load(open(model_path, "rb"))["model"]
-        new_checkpoint = {}
-        for k, v in checkpoint.items():
-            new_checkpoint[k] = torch.from_numpy(v)
-        checkpoint = new_checkpoint
+        checkpoint = _load_checkpoint(model_path)
 
         self.bottom_up.load_state_dict(checkpoint, strict=False)
 
@@ -255,6 +352,42 @@ class FPN(Backbone):
             print("successfully load model from {}".format(model_path))
 
 
+def _load_checkpoint(model_path):
+    """
+    Read the "model" weights of a detectron2 style .pkl checkpoint as tensors.
+    A .safetensors file holding the same keys is memory-mapped instead, which
+    skips unpickling and the intermediate numpy copies.
+
+    Returns:
+        dict[str: Tensor]
+    """
+    if model_path.endswith(".safetensors"):
+        from safetensors.torch import load_file
+
+        return load_file(model_path)
+    with open(model_path, "rb") as f:
+        checkpoint = pkl.load(f)["model"]
+    return {k: torch.from_numpy(v) for k, v in checkpoint.items()}
+
+
+def _top_down_step(output_conv, lateral_features, prev_features, scale):
+    """
+    One top-down FPN level: fuse the lateral conv output with the upsampled
+    coarser level, then apply the 3x3 output conv. The lateral conv is run by
+    the caller, possibly on a side stream.
+
+    Returns:
+        (Tensor, Tensor): the fused features fed to the next level, and the
+            output feature map of this level.
+    """
+    # the lateral output is a temporary, so the add can go in place; a traced
+    # and frozen graph then shows the conv + add_ pattern the JIT fuses.
+    prev_features = upsample2x_add(
+        prev_features, lateral_features, scale, inplace=True
+    )
+    return prev_features, output_conv(prev_features)
+
+
 def _assert_strides_are_log2_contiguous(strides):
     """
     Assert that each stride is 2x times its preceding stride, i.e. "contiguous in log2".
@@ -317,6 +450,227 @@ class LastLevelP6P7(nn.Module):
         return [p6, p7]
 
 
+def compile_fpn_backbone(backbone, mode=None, top_down_only=False):
+    """
+    Compile an FPN backbone with `torch.compile` so the whole top-down pyramid
+    is captured as one graph. The builders below return the eager module, since
+    training and checkpoint loading rely on its attributes and state dict keys;
+    call this on the built backbone for fixed-shape inference.
+
+    With `top_down_only`, only the per-level step (upsample-add, output conv)
+    is compiled with `fullgraph=True`. The conv still runs as a cuDNN call; the
+    gain is that Inductor merges the nearest upsample, the add and the "avg"
+    scale into a single pointwise kernel. The backbone itself stays an eager
+    module and remains usable for training. The step is compiled once per
+    pyramid level, since Dynamo guards on the identity of its `output_conv`.
+    It accumulates into its lateral input in place, and Inductor does not
+    CUDA-graph graphs that mutate their inputs, so it defaults to a mode
+    without CUDA graphs.
+
+    Args:
+        backbone (FPN): the backbone to compile.
+        mode (str or None): compilation mode passed to `torch.compile`.
+            Defaults to "reduce-overhead" for the whole backbone and
+            "max-autotune-no-cudagraphs" with `top_down_only`.
+        top_down_only (bool): compile only the top-down step, in place.
+
+    Returns:
+        nn.Module: the compiled backbone, or `backbone` itself if this version
+            of PyTorch has no `torch.compile` or `top_down_only` is set.
+    """
+    if not hasattr(torch, "compile"):
+        return backbone
+    if top_down_only:
+        if mode is None:
+            mode = "max-autotune-no-cudagraphs"
+        backbone._top_down_step = torch.compile(
+            _top_down_step, fullgraph=True, dynamic=False, mode=mode
+        )
+        return backbone
+    if mode is None:
+        mode = "reduce-overhead"
+    return torch.compile(backbone, dynamic=False, mode=mode)
+
+
+def freeze_fpn_backbone(backbone, example_input):
+    """
+    Convert an FPN backbone into a frozen TorchScript module for inference.
+
+    The bottom-up Conv2d wrapper dispatches empty inputs to an autograd
+    Function, which TorchScript cannot compile, so the backbone is traced on
+    `example_input` rather than scripted. Freezing then inlines the weights as
+    constants, and `optimize_for_inference` runs the frozen-graph passes such
+    as conv + add fusion on the lateral connections.
+
+    Args:
+        backbone (FPN): the backbone to convert. It is switched to eval mode.
+        example_input (Tensor): an image batch with the shape used at inference.
+
+    Returns:
+        torch.jit.ScriptModule: the traced (and, where supported, frozen and
+            optimized) backbone.
+    """
+    backbone = backbone.eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(backbone, example_input, strict=False)
+    if hasattr(torch.jit, "optimize_for_inference"):
+        traced = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+    elif hasattr(torch.jit, "freeze"):
+        traced = torch.jit.freeze(traced)
+    return traced
+
+
+class _FPNFeatures(nn.Module):
+    """
+    Exposes :meth:`FPN.forward_features` as `forward`, for tools that only
+    export a module's forward.
+    """
+
+    def __init__(self, fpn):
+        super().__init__()
+        self.fpn = fpn
+
+    def forward(self, x):
+        return self.fpn.forward_features(x)
+
+
+def export_fpn_backbone(backbone, example_input, package_path):
+    """
+    Ahead-of-time compile an FPN backbone for the exact shape of
+    `example_input` with `torch.export` and AOTInductor (max-autotune), and
+    save the result to `package_path`. Compilation takes minutes, but the
+    package can be reloaded with `torch._inductor.aoti_load_package` and
+    skips both Python dispatch and kernel selection at run time.
+
+    Args:
+        backbone (FPN): the backbone to export. It is switched to eval mode.
+        example_input (Tensor): an image batch with the shape used at inference.
+        package_path (str): where to write the compiled package.
+
+    Returns:
+        callable: maps an image batch to the tuple returned by
+            :meth:`FPN.forward_features`.
+
+    Raises:
+        RuntimeError: if this version of PyTorch lacks `torch.export` or
+            AOTInductor packaging.
+    """
+    if not hasattr(torch, "export"):
+        raise RuntimeError("export_fpn_backbone requires torch.export")
+    if not hasattr(torch, "_inductor") or not hasattr(
+        torch._inductor, "aoti_compile_and_package"
+    ):
+        raise RuntimeError(
+            "export_fpn_backbone requires torch._inductor.aoti_compile_and_package"
+        )
+    compile_and_package = torch._inductor.aoti_compile_and_package
+    # PyTorch 2.5 still takes the example inputs positionally; later versions
+    # read them from the exported program
+    compile_args = ()
+    if "args" in inspect.signature(compile_and_package).parameters:
+        compile_args = ((example_input,),)
+    features = _FPNFeatures(backbone.eval())
+    with torch.no_grad():
+        program = torch.export.export(features, (example_input,))
+        package_path = compile_and_package(
+            program,
+            *compile_args,
+            package_path=package_path,
+            inductor_configs={"max_autotune": True},
+        )
+    return torch._inductor.aoti_load_package(package_path)
+
+
+def export_fpn_backbone_trt(backbone, example_input, half=True):
+    """
+    Build a TensorRT engine for an FPN backbone at the shape of
+    `example_input`, using torch_tensorrt (an optional dependency). The frozen
+    trace of :meth:`FPN.forward_features` is handed to TensorRT, which fuses
+    the convs with the upsample-add and, with `half`, runs them in fp16.
+
+    Args:
+        backbone (FPN): the backbone to export. It is switched to eval mode.
+        example_input (Tensor): a CUDA image batch with the shape used at
+            inference.
+        half (bool): allow fp16 kernels in addition to fp32.
+
+    Returns:
+        torch.jit.ScriptModule: maps an image batch to the tuple returned by
+            :meth:`FPN.forward_features`.
+    """
+    import torch_tensorrt
+
+    features = _FPNFeatures(backbone.eval())
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(features, example_input))
+    precisions = {torch.float, torch.half} if half else {torch.float}
+    return torch_tensorrt.compile(
+        traced, ir="ts", inputs=[example_input], enabled_precisions=precisions
+    )
+
+
+def convert_fpn_to_channels_last(backbone):
+    """
+    Switch an FPN backbone, including its bottom up network and top block, to
+    the channels_last (NHWC) memory format, which cuDNN's tensor core
+    convolutions run on natively. Input images are converted once at the start
+    of forward and the layout then propagates through every level, so the
+    returned feature maps are channels_last too.
+
+    Args:
+        backbone (FPN): the backbone to convert, in place.
+
+    Returns:
+        FPN: `backbone`, unchanged if this version of PyTorch has no
+            channels_last memory format.
+    """
+    if not hasattr(torch, "channels_last"):
+        return backbone
+    backbone.to(memory_format=torch.channels_last)
+    backbone._channels_last = True
+    return backbone
+
+
+def enable_fpn_lateral_stream(backbone):
+    """
+    Run the FPN lateral 1x1 convs on a separate CUDA stream so they overlap
+    with the sequential top-down chain on the current stream. This mostly helps
+    at small spatial sizes, where single convs cannot fill the GPU. It only
+    applies to eager CUDA execution and is skipped for CPU inputs. One side
+    stream is created per input device, on first use.
+
+    Args:
+        backbone (FPN): the backbone to modify, in place.
+
+    Returns:
+        FPN: `backbone`.
+    """
+    backbone._lateral_streams = {}
+    return backbone
+
+
+def enable_fpn_autocast(backbone, dtype=torch.bfloat16):
+    """
+    Run the FPN forward under `torch.autocast`, so its convs execute in reduced
+    precision on tensor cores and move half the bytes of fp32. bfloat16 keeps
+    the fp32 exponent range and needs no loss scaling. The returned feature
+    maps are in `dtype`; cast them back before feeding ops that expect fp32.
+    Combine with :func:`convert_fpn_to_channels_last` for the NHWC kernels.
+
+    Args:
+        backbone (FPN): the backbone to modify, in place.
+        dtype (torch.dtype): autocast dtype, or None to turn autocast off.
+
+    Returns:
+        FPN: `backbone`, unchanged if this version of PyTorch has no
+            `torch.autocast`.
+    """
+    if not hasattr(torch, "autocast"):
+        return backbone
+    backbone._autocast_dtype = dtype
+    return backbone
+
+
 def build_resnet_fpn_backbone(cfg):
     """
     Args:
@@ -407,8 +761,26 @@ if __name__ == "__main__":
             "/home/shitaot/work_dirs/pretrain_model/res50_gn_fpn_AP42.6.pkl"
         )
         img = torch.rand(32, 3, 384, 288).cuda()
-        for i in range(10000):
-            outs = fpn(img)
-            for k, v in outs.items():
-                print(k, v.shape)
+        # the graph is captured below, so Inductor must not add its own
+        fpn = compile_fpn_backbone(fpn.eval(), mode="max-autotune-no-cudagraphs")
+
+        # warm up on a side stream before capture; the first call also
+        # compiles and autotunes kernels for this input shape
+        static_img = img.clone()
+        warmup_stream = torch.cuda.Stream()
+        warmup_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(warmup_stream):
+            for _ in range(3):
+                fpn(static_img)
+        torch.cuda.current_stream().wait_stream(warmup_stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            static_outs = fpn(static_img)
+        for k, v in static_outs.items():
+            print(k, v.shape)
 
+        for i in range(10000):
+            static_img.copy_(img)
+            graph.replay()
+        torch.cuda.synchronize()
@@ -29,6 +29,14 @@ setup(
             ["nms/src/nms.cpp", "nms/src/nms_kernel.cu"],
             extra_compile_args={"cxx": ["-g"], "nvcc": ["-O2"]},
         ),
+        CUDAExtension(
+            "upsample_add",
+            [
+                "upsample_add/src/upsample_add.cpp",
+                "upsample_add/src/upsample_add_kernel.cu",
+            ],
+            extra_compile_args={"cxx": ["-g"], "nvcc": ["-O2"]},
+        ),
     ],
     cmdclass={"build_ext": BuildExtension},
 )
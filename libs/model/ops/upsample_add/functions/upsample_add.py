@@ -0,0 +1,20 @@
+import upsample_add
+import torch.nn.functional as F
+from torch.autograd import Function
+
+
+class UpsampleAdd(Function):
+    @staticmethod
+    def forward(ctx, prev, lateral, scale):
+        ctx.scale = scale
+        return upsample_add.upsample2x_add_forward(prev, lateral, scale)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad_lateral = grad_output * ctx.scale
+        # each prev pixel was copied into a 2x2 block of the output
+        grad_prev = F.avg_pool2d(grad_lateral, kernel_size=2) * 4
+        return grad_prev, grad_lateral, None
+
+
+upsample_add_op = UpsampleAdd.apply
@@ -0,0 +1,27 @@
+#include "upsample_add.h"
+#include <torch/extension.h>
+#define CHECK_CUDA(x) TORCH_CHECK(x.type().is_cuda(), #x " must be a CUDA tensor")
+#define CHECK_CONTIGUOUS(x) TORCH_CHECK(x.is_contiguous(), #x " must be contiguous")
+#define CHECK_INPUT(x) CHECK_CUDA(x); CHECK_CONTIGUOUS(x)
+
+// == Forward
+torch::Tensor upsample2x_add_forward(torch::Tensor prev, //prev: N, C, H/2, W/2
+                      torch::Tensor lateral, //lateral: N, C, H, W
+                      double scale){
+    CHECK_INPUT(prev);
+    CHECK_INPUT(lateral);
+    TORCH_CHECK(prev.dim() == 4 && lateral.dim() == 4, "inputs must be 4D (N, C, H, W)");
+    TORCH_CHECK(prev.scalar_type() == lateral.scalar_type(), "inputs must have the same dtype");
+    TORCH_CHECK(prev.device() == lateral.device(), "inputs must be on the same device");
+    TORCH_CHECK(prev.size(0) == lateral.size(0) && prev.size(1) == lateral.size(1),
+                "prev and lateral must have the same batch and channel sizes");
+    TORCH_CHECK(lateral.size(2) == 2 * prev.size(2) && lateral.size(3) == 2 * prev.size(3),
+                "lateral must be exactly twice the spatial size of prev");
+
+    return upsample2x_add_on_gpu(prev, lateral, scale);
+}
+
+
+PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
+  m.def("upsample2x_add_forward", &upsample2x_add_forward, "nearest 2x upsample + add forward (CUDA)");
+}
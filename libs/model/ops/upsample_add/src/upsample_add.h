@@ -0,0 +1,9 @@
+#ifndef _UPSAMPLE_ADD_CUDA
+#define _UPSAMPLE_ADD_CUDA
+#include <torch/extension.h>
+
+torch::Tensor upsample2x_add_on_gpu(torch::Tensor prev, //prev: N, C, H/2, W/2
+    torch::Tensor lateral, //lateral: N, C, H, W
+    double scale);
+
+#endif
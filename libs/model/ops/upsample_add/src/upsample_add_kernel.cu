@@ -0,0 +1,71 @@
+#include <ATen/AccumulateType.h>
+#include <ATen/cuda/CUDAContext.h>
+#include <c10/cuda/CUDAException.h>
+#include <c10/cuda/CUDAGuard.h>
+#include <torch/extension.h>
+#include "upsample_add.h"
+
+#define THREADS_PER_BLOCK 256
+
+// out[nc][h][w] = (lateral[nc][h][w] + prev[nc][h / 2][w / 2]) * scale
+//
+// One grid row per (n, c) plane so small pyramid levels with many channels
+// still fill the device; the upsampled tensor is never written out.
+template <typename scalar_t>
+__global__ void upsample2x_add_kernel(
+  const scalar_t* __restrict__ prev,
+  const scalar_t* __restrict__ lateral,
+  scalar_t* __restrict__ out,
+  const int H,
+  const int W,
+  const float scale){
+    using acc_t = at::acc_type<scalar_t, true>;
+
+    const int64_t nc = blockIdx.x;
+    const int hw = blockIdx.y * blockDim.x + threadIdx.x;
+    if (hw >= H * W) {
+      return;
+    }
+    const int h = hw / W;
+    const int w = hw - h * W;
+    const int W_prev = W / 2;
+
+    const int64_t out_idx = nc * H * W + hw;
+    const int64_t prev_idx = nc * (H / 2) * W_prev + (h >> 1) * W_prev + (w >> 1);
+    const acc_t sum = static_cast<acc_t>(lateral[out_idx]) + static_cast<acc_t>(prev[prev_idx]);
+    out[out_idx] = static_cast<scalar_t>(sum * static_cast<acc_t>(scale));
+  }
+
+torch::Tensor upsample2x_add_on_gpu(torch::Tensor prev, //prev: N, C, H/2, W/2
+    torch::Tensor lateral, //lateral: N, C, H, W
+    double scale){
+        const auto N = lateral.size(0);
+        const auto C = lateral.size(1);
+        const int H = lateral.size(2);
+        const int W = lateral.size(3);
+
+        // allocate and launch on the inputs' device, not the current one
+        const at::cuda::OptionalCUDAGuard device_guard(device_of(lateral));
+        auto out = torch::empty_like(lateral);
+        if (out.numel() == 0) {
+          return out;
+        }
+
+        // (n, c) planes go on grid.x, which unlike grid.y is not capped at 65535.
+        dim3 blocks(N * C, (H * W + THREADS_PER_BLOCK - 1) / THREADS_PER_BLOCK);
+        dim3 threadsPerBlock(THREADS_PER_BLOCK);
+        cudaStream_t stream = at::cuda::getCurrentCUDAStream();
+
+        AT_DISPATCH_FLOATING_TYPES_AND2(at::ScalarType::Half, at::ScalarType::BFloat16,
+          lateral.scalar_type(), "upsample2x_add_kernel", ([&] {
+            upsample2x_add_kernel<scalar_t><<<blocks, threadsPerBlock, 0, stream>>>(
+                prev.data_ptr<scalar_t>(),
+                lateral.data_ptr<scalar_t>(),
+                out.data_ptr<scalar_t>(),
+                H,
+                W,
+                static_cast<float>(scale));
+            C10_CUDA_KERNEL_LAUNCH_CHECK();
+          }));
+        return out;
+    }